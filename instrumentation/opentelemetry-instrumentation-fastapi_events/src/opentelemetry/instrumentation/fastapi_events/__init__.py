@@ -39,81 +39,599 @@ Usage
     async def index():
         dispatch("VISITOR_SPOTTED")
         return {"message": "visitor spotted"}
+
+Setting up tracing
+------------------
+
+Every dispatched event produces a ``fastapi_events.dispatch`` span. Events
+dispatched during a request are handled in a batch once the response has
+been sent, which is recorded as a single ``fastapi_events.handle_many`` span
+per handler with a span event for each event in the batch. Events
+dispatched outside of a request produce a ``fastapi_events.handle`` span per
+handler.
+
+Spans are started with the ``messaging.system`` and ``messaging.operation``
+attributes only. The event name is recorded as ``messaging.destination``
+once the span is known to be recording, so it is not available to
+samplers.
+
+Passing ``record_per_event_spans=True`` to ``instrument()`` additionally
+records a ``fastapi_events.handle`` span for every event handled as part of
+a batch, at the cost of one extra span per event and handler.
+
+Events dispatched by an event handler are traced as part of the handler's
+span and do not get a ``fastapi_events.dispatch`` span of their own unless
+``trace_nested_dispatch=True`` is passed to ``instrument()``.
+
+Applications dispatching many events per request should size the SDK's
+``BatchSpanProcessor`` for that volume, either in code or through the
+``OTEL_BSP_MAX_QUEUE_SIZE``, ``OTEL_BSP_MAX_EXPORT_BATCH_SIZE`` and
+``OTEL_BSP_SCHEDULE_DELAY`` environment variables, so that spans are not
+dropped when the queue fills up between exports.
+
+.. code-block:: python
+
+    from opentelemetry import trace
+    from opentelemetry.sdk.trace import TracerProvider
+    from opentelemetry.sdk.trace.export import BatchSpanProcessor
+
+    tracer_provider = TracerProvider()
+    tracer_provider.add_span_processor(
+        BatchSpanProcessor(
+            exporter,
+            max_queue_size=8192,
+            max_export_batch_size=2048,
+            schedule_delay_millis=1000,
+        )
+    )
+    trace.set_tracer_provider(tracer_provider)
+
+    FastAPIEventsInstrumentor().instrument(tracer_provider=tracer_provider)
+
+API
+---
 """
 
-from inspect import getmembers, isclass, ismodule
-from typing import Collection
+# pylint: disable=import-outside-toplevel
+
+import collections.abc
+import functools
+import inspect
+import weakref
+from types import MappingProxyType
+from typing import (
+    AbstractSet,
+    Any,
+    Collection,
+    Dict,
+    Iterator,
+    Optional,
+    Tuple,
+)
 
-import fastapi_events
-import fastapi_events.dispatcher
 import wrapt
-from fastapi_events.handlers.base import BaseEventHandler
 
-from opentelemetry import trace
+from opentelemetry import context, trace
+from opentelemetry.context import attach, detach, get_value, set_value
 from opentelemetry.instrumentation.fastapi_events.package import _instruments
+from opentelemetry.instrumentation.fastapi_events.version import __version__
 from opentelemetry.instrumentation.instrumentor import BaseInstrumentor
-from opentelemetry.instrumentation.utils import unwrap
-from opentelemetry.trace import SpanKind
+from opentelemetry.instrumentation.utils import (
+    _SUPPRESS_INSTRUMENTATION_KEY,
+    unwrap,
+)
+from opentelemetry.semconv.trace import (
+    MessagingOperationValues,
+    SpanAttributes,
+)
+from opentelemetry.trace import (
+    Link,
+    NoOpTracer,
+    Span,
+    SpanContext,
+    SpanKind,
+    Tracer,
+    set_span_in_context,
+)
+from opentelemetry.trace.status import Status, StatusCode
+
+_CONSUMER = SpanKind.CONSUMER
+_PRODUCER = SpanKind.PRODUCER
+
+_MESSAGING_SYSTEM = "fastapi_events"
+_PROCESS_OPERATION = MessagingOperationValues.PROCESS.value
+
+# Attributes every span starts with. They are shared between all spans to
+# save building a dict per span (the SDK copies them into the span); the
+# event name is only added once the span is known to be recording.
+_DISPATCH_SPAN_ATTRIBUTES = MappingProxyType(
+    {SpanAttributes.MESSAGING_SYSTEM: _MESSAGING_SYSTEM}
+)
+_HANDLE_SPAN_ATTRIBUTES = MappingProxyType(
+    {
+        SpanAttributes.MESSAGING_SYSTEM: _MESSAGING_SYSTEM,
+        SpanAttributes.MESSAGING_OPERATION: _PROCESS_OPERATION,
+    }
+)
+
+_DISPATCH_SPAN_NAME = "fastapi_events.dispatch"
+_HANDLE_SPAN_NAME = "fastapi_events.handle"
+_HANDLE_MANY_SPAN_NAME = "fastapi_events.handle_many"
+
+_ORIGINAL_ATTR_PREFIX = "_otel_original_"
+_INSTRUMENTED_ATTR = "_otel_instrumented"
+# wrapt stores attributes prefixed with _self_ on the proxy itself instead
+# of passing them through to the wrapped function.
+_DISPATCH_INSTRUMENTED_ATTR = "_self" + _INSTRUMENTED_ATTR
+
+_TRACER: Optional[Tracer] = None
+_RECORD_PER_EVENT_SPANS = False
+_TRACE_NESTED_DISPATCH = False
+
+# Set while a batch is being handled without per-event spans, so that the
+# handle() calls made for the batch do not start spans of their own.
+_SUPPRESS_HANDLE_SPANS_KEY = context.create_key(
+    "suppress_fastapi_events_handle_spans"
+)
+# Set while an event is being handled unless nested dispatches are traced,
+# so that events dispatched by handlers do not start dispatch spans.
+_SUPPRESS_DISPATCH_SPANS_KEY = context.create_key(
+    "suppress_fastapi_events_dispatch_spans"
+)
+# Set while a batch is being handled, to the dispatch span contexts of its
+# events, so that the handle() calls made for the batch can link to them.
+_DISPATCH_SPAN_CONTEXTS_KEY = context.create_key(
+    "fastapi_events_dispatch_span_contexts"
+)
+# Set while an instrumented handle() or handle_many() runs, to the handler
+# and the event or events it was called with, so that overrides calling
+# super() do not start a second span for the same call.
+_ACTIVE_HANDLE_KEY = context.create_key("fastapi_events_active_handle")
+_ACTIVE_HANDLE_MANY_KEY = context.create_key(
+    "fastapi_events_active_handle_many"
+)
+
+# Span contexts of the spans that dispatched the events queued during a
+# request, by id of the event store queue and then by id of the event.
+# Events are only handled once the response has been sent, outside of the
+# dispatching span, so the handling spans link back to it instead. The
+# events themselves are left untouched; they are kept alongside their span
+# contexts so that their ids cannot be reused while they are queued. The
+# entries of a queue are dropped once the queue is collected at the end of
+# the request.
+_DISPATCH_SPAN_CONTEXTS: Dict[int, Dict[int, Tuple[Any, SpanContext]]] = {}
+
+
+def _get_tracer() -> Tracer:
+    global _TRACER  # pylint: disable=global-statement
+    if _TRACER is None:
+        _TRACER = trace.get_tracer(__name__, __version__)
+    return _TRACER
 
 
-async def _handle_wrapper(wrapped, instance, args, kwargs):
-    tracer = trace.get_tracer(__name__)
-    event = args[0] if args else kwargs.get("event")
-    with tracer.start_as_current_span(
-        f"handling event {event[0]}", kind=SpanKind.CONSUMER
-    ) as span:
-        return await wrapped(event)
+def _should_trace(tracer: Tracer) -> bool:
+    # A no-op tracer never produces spans, so skip the span and context
+    # bookkeeping entirely. trace.get_tracer() usually returns a
+    # ProxyTracer, which delegates to a no-op tracer until an SDK tracer
+    # provider is set, so look at the tracer it currently delegates to.
+    tracer = getattr(tracer, "_tracer", tracer)
+    return not isinstance(tracer, NoOpTracer) and not get_value(
+        _SUPPRESS_INSTRUMENTATION_KEY
+    )
+
+
+def _add_dispatch_span_context(queue, event, span_context: SpanContext):
+    queue_id = id(queue)
+    span_contexts = _DISPATCH_SPAN_CONTEXTS.get(queue_id)
+    if span_contexts is None:
+        try:
+            weakref.finalize(
+                queue, _DISPATCH_SPAN_CONTEXTS.pop, queue_id, None
+            )
+        except TypeError:
+            # The queue cannot be weakly referenced, so there would be no
+            # way of knowing when to drop its entries.
+            return
+        span_contexts = _DISPATCH_SPAN_CONTEXTS[queue_id] = {}
+    span_contexts[id(event)] = (event, span_context)
+
+
+def _get_link(span_contexts, event) -> Optional[Link]:
+    entry = span_contexts.get(id(event)) if span_contexts else None
+    if entry is None or entry[0] is not event:
+        return None
+    return Link(entry[1])
+
+
+def _get_event_name(event) -> Optional[str]:
+    # fastapi-events passes events around as (event_name, payload) tuples,
+    # but any sequence works with its handlers; fall back to a ``name``
+    # attribute for event objects. Events of any other shape have no name
+    # rather than failing the handler.
+    if isinstance(event, collections.abc.Sequence) and not isinstance(
+        event, str
+    ):
+        event_name = event[0] if event else None
+    else:
+        event_name = getattr(event, "name", None)
+    return None if event_name is None else str(event_name)
+
+
+def _record_exception(span: Span, exc: Exception):
+    # Mirrors what start_as_current_span does for exceptions raised
+    # inside of it.
+    if span.is_recording():
+        span.record_exception(exc)
+        span.set_status(
+            Status(
+                status_code=StatusCode.ERROR,
+                description=f"{type(exc).__name__}: {exc}",
+            )
+        )
+
+
+def _start_handle_span(tracer: Tracer, event) -> Span:
+    # The spans are managed by hand rather than with start_as_current_span
+    # to avoid the context manager machinery on every handled event.
+    # The event name is resolved before the span is started so that
+    # nothing can fail between starting the span and the caller ending it.
+    event_name = _get_event_name(event)
+    link = _get_link(get_value(_DISPATCH_SPAN_CONTEXTS_KEY), event)
+    span = tracer.start_span(
+        _HANDLE_SPAN_NAME,
+        kind=_CONSUMER,
+        attributes=_HANDLE_SPAN_ATTRIBUTES,
+        links=[link] if link is not None else None,
+    )
+    if event_name is not None and span.is_recording():
+        span.set_attribute(SpanAttributes.MESSAGING_DESTINATION, event_name)
+    return span
 
 
-async def _handle_many_wrapper(wrapped, instance, args, kwargs):
-    tracer = trace.get_tracer(__name__)
-    events = args[0] if args else kwargs.get("events")
-    with tracer.start_as_current_span(
-        f"handling multiple events", kind=SpanKind.CONSUMER
-    ) as span:
-        return await wrapped(events)
+def _start_handle_many_span(tracer: Tracer, events, span_contexts) -> Span:
+    # Only look at the events when iterating over them cannot consume them.
+    if not isinstance(events, collections.abc.Collection):
+        events = ()
+
+    links = []
+    if span_contexts:
+        for event in events:
+            link = _get_link(span_contexts, event)
+            if link is not None:
+                links.append(link)
+    span = tracer.start_span(
+        _HANDLE_MANY_SPAN_NAME,
+        kind=_CONSUMER,
+        attributes=_HANDLE_SPAN_ATTRIBUTES,
+        links=links or None,
+    )
+    if not _RECORD_PER_EVENT_SPANS and span.is_recording():
+        for event in events:
+            event_name = _get_event_name(event)
+            if event_name is not None:
+                span.add_event(event_name)
+    return span
+
+
+def _get_handle_context(
+    span: Span, handler, event, batch: bool = False, span_contexts=None
+) -> context.Context:
+    ctx = set_span_in_context(span)
+    if batch:
+        ctx = set_value(_ACTIVE_HANDLE_MANY_KEY, (handler, event), ctx)
+        if not _RECORD_PER_EVENT_SPANS:
+            ctx = set_value(_SUPPRESS_HANDLE_SPANS_KEY, True, ctx)
+    else:
+        ctx = set_value(_ACTIVE_HANDLE_KEY, (handler, event), ctx)
+    if span_contexts:
+        ctx = set_value(_DISPATCH_SPAN_CONTEXTS_KEY, span_contexts, ctx)
+    if not _TRACE_NESTED_DISPATCH:
+        ctx = set_value(_SUPPRESS_DISPATCH_SPANS_KEY, True, ctx)
+    return ctx
+
+
+def _is_active(key: str, handler, event) -> bool:
+    active = get_value(key)
+    return active is not None and active[0] is handler and active[1] is event
+
+
+def _should_trace_handle(tracer: Tracer, handler, event) -> bool:
+    return (
+        _should_trace(tracer)
+        and not get_value(_SUPPRESS_HANDLE_SPANS_KEY)
+        and not _is_active(_ACTIVE_HANDLE_KEY, handler, event)
+    )
+
+
+def _should_trace_handle_many(tracer: Tracer, handler, events) -> bool:
+    return _should_trace(tracer) and not _is_active(
+        _ACTIVE_HANDLE_MANY_KEY, handler, events
+    )
 
 
-def _dispatch_wrapper(wrapped, instance, args, kwargs):
-    event_name = kwargs.get("event_name")
-    tracer = trace.get_tracer(__name__)
+async def _await_in_span(awaitable, span: Span, ctx: context.Context):
+    token = attach(ctx)
+    try:
+        return await awaitable
+    except Exception as exc:
+        _record_exception(span, exc)
+        raise
+    finally:
+        detach(token)
+        span.end()
 
-    with tracer.start_as_current_span(
-        f"Event {event_name} dispatched", kind=SpanKind.PRODUCER
-    ) as span:
-        return wrapped(*args, **kwargs)
+
+def _call_in_span(method, handler, arg, span: Span, ctx: context.Context):
+    token = attach(ctx)
+    end_span = True
+    try:
+        result = method(handler, arg)
+        if inspect.isawaitable(result):
+            # A plain function returning an awaitable, e.g. a coroutine
+            # function behind a decorator that is not coroutine aware. The
+            # span has to last until the awaitable is done.
+            end_span = False
+            return _await_in_span(result, span, ctx)
+        return result
+    except Exception as exc:
+        _record_exception(span, exc)
+        raise
+    finally:
+        detach(token)
+        if end_span:
+            span.end()
+
+
+def _wrap_handle(handle):
+    # Pick the wrapper once at patch time so that handlers implemented as
+    # plain functions are not forced through a coroutine.
+    if inspect.iscoroutinefunction(handle):
+
+        @functools.wraps(handle)
+        async def _handle_wrapper_async(self, event):
+            tracer = _get_tracer()
+            if not _should_trace_handle(tracer, self, event):
+                return await handle(self, event)
+
+            span = _start_handle_span(tracer, event)
+            token = attach(_get_handle_context(span, self, event))
+            try:
+                return await handle(self, event)
+            except Exception as exc:
+                _record_exception(span, exc)
+                raise
+            finally:
+                detach(token)
+                span.end()
+
+        return _handle_wrapper_async
+
+    @functools.wraps(handle)
+    def _handle_wrapper_sync(self, event):
+        tracer = _get_tracer()
+        if not _should_trace_handle(tracer, self, event):
+            return handle(self, event)
+
+        span = _start_handle_span(tracer, event)
+        return _call_in_span(
+            handle, self, event, span, _get_handle_context(span, self, event)
+        )
+
+    return _handle_wrapper_sync
+
+
+def _wrap_handle_many(handle_many):
+    if inspect.iscoroutinefunction(handle_many):
+
+        @functools.wraps(handle_many)
+        async def _handle_many_wrapper_async(self, events):
+            tracer = _get_tracer()
+            if not _should_trace_handle_many(tracer, self, events):
+                return await handle_many(self, events)
+
+            span_contexts = _DISPATCH_SPAN_CONTEXTS.get(id(events))
+            span = _start_handle_many_span(tracer, events, span_contexts)
+            token = attach(
+                _get_handle_context(
+                    span, self, events, batch=True, span_contexts=span_contexts
+                )
+            )
+            try:
+                return await handle_many(self, events)
+            except Exception as exc:
+                _record_exception(span, exc)
+                raise
+            finally:
+                detach(token)
+                span.end()
+
+        return _handle_many_wrapper_async
+
+    @functools.wraps(handle_many)
+    def _handle_many_wrapper_sync(self, events):
+        tracer = _get_tracer()
+        if not _should_trace_handle_many(tracer, self, events):
+            return handle_many(self, events)
+
+        span_contexts = _DISPATCH_SPAN_CONTEXTS.get(id(events))
+        span = _start_handle_many_span(tracer, events, span_contexts)
+        ctx = _get_handle_context(
+            span, self, events, batch=True, span_contexts=span_contexts
+        )
+        return _call_in_span(handle_many, self, events, span, ctx)
+
+    return _handle_many_wrapper_sync
+
+
+def _patch(class_, name, wrapper_factory):
+    # Patch the class directly instead of through a wrapt proxy. Only
+    # methods the class defines itself are patched: inherited ones are
+    # covered by patching the class that defines them.
+    # Methods already carrying the sentinel were patched by another copy of
+    # this module (e.g. after a reload) and must not be wrapped again.
+    method = vars(class_).get(name)
+    if (
+        method is None
+        or getattr(method, "__isabstractmethod__", False)
+        or getattr(method, _INSTRUMENTED_ATTR, False)
+    ):
+        return
+
+    wrapper = wrapper_factory(method)
+    setattr(wrapper, _INSTRUMENTED_ATTR, True)
+    setattr(class_, _ORIGINAL_ATTR_PREFIX + name, method)
+    setattr(class_, name, wrapper)
+
+
+def _unpatch(class_, name):
+    original_attr = _ORIGINAL_ATTR_PREFIX + name
+    original = vars(class_).get(original_attr)
+    if original is None:
+        return
+
+    delattr(class_, original_attr)
+    setattr(class_, name, original)
+
+
+def _wrap_dispatch(event_store):
+    """Wraps ``fastapi_events.dispatcher._dispatch``, given the event store
+    that it queues events into during a request."""
+
+    def _dispatch_wrapper(wrapped, instance, args, kwargs):
+        tracer = _get_tracer()
+        if not _should_trace(tracer):
+            return wrapped(*args, **kwargs)
+
+        if get_value(_SUPPRESS_DISPATCH_SPANS_KEY):
+            if not get_value(_SUPPRESS_HANDLE_SPANS_KEY):
+                return wrapped(*args, **kwargs)
+
+            # The event still gets handle spans of its own, as below.
+            token = attach(set_value(_SUPPRESS_HANDLE_SPANS_KEY, False))
+            try:
+                return wrapped(*args, **kwargs)
+            finally:
+                detach(token)
+
+        span = tracer.start_span(
+            _DISPATCH_SPAN_NAME,
+            kind=_PRODUCER,
+            attributes=_DISPATCH_SPAN_ATTRIBUTES,
+        )
+        if span.is_recording():
+            event_name = args[0] if args else kwargs.get("event_name")
+            if event_name is not None:
+                span.set_attribute(
+                    SpanAttributes.MESSAGING_DESTINATION, str(event_name)
+                )
+        ctx = set_span_in_context(span)
+        if get_value(_SUPPRESS_HANDLE_SPANS_KEY, ctx):
+            # Events dispatched from within a batch are handled on their
+            # own, so their handle spans must not be suppressed along with
+            # the batch's.
+            ctx = set_value(_SUPPRESS_HANDLE_SPANS_KEY, False, ctx)
+        token = attach(ctx)
+        try:
+            # Within a request, _dispatch queues the event for the
+            # middleware to handle later; remember this span for it so the
+            # handling spans can link back to it. Outside of a request the
+            # event is handled in a task that inherits this span as its
+            # parent.
+            queue = event_store.get(None)
+            queue_length = len(queue) if queue is not None else 0
+
+            result = wrapped(*args, **kwargs)
+
+            if (
+                span.is_recording()
+                and queue is not None
+                and len(queue) == queue_length + 1
+            ):
+                _add_dispatch_span_context(
+                    queue, queue[-1], span.get_span_context()
+                )
+
+            return result
+        except Exception as exc:
+            _record_exception(span, exc)
+            raise
+        finally:
+            detach(token)
+            span.end()
+
+    return _dispatch_wrapper
+
+
+def _is_dispatch_instrumented(dispatcher) -> bool:
+    return isinstance(dispatcher._dispatch, wrapt.ObjectProxy) and getattr(
+        dispatcher._dispatch, _DISPATCH_INSTRUMENTED_ATTR, False
+    )
+
+
+def _get_handler_classes() -> Iterator[type]:
+    """Yields BaseEventHandler and every subclass of it defined so far."""
+    from fastapi_events.handlers.base import BaseEventHandler
+
+    yield BaseEventHandler
+
+    seen = set()
+    stack = [BaseEventHandler]
+    while stack:
+        for subclass in stack.pop().__subclasses__():
+            if subclass not in seen:
+                seen.add(subclass)
+                stack.append(subclass)
+                yield subclass
 
 
 class FastAPIEventsInstrumentor(BaseInstrumentor):
-    def __init__(self):
-        super().__init__()
-        self._instrumented_classes = []
+    # Replaced by _instrument; the default keeps _uninstrument safe to call
+    # before instrumenting.
+    _instrumented_classes: AbstractSet[type] = frozenset()
 
     def instrumentation_dependencies(self) -> Collection[str]:
         return _instruments
 
     def _instrument(self, **kwargs):
-        for _, module in getmembers(fastapi_events.handlers, ismodule):
-            for _, class_ in getmembers(module, isclass):
-                if (
-                    issubclass(class_, BaseEventHandler)
-                    and class_ is not BaseEventHandler
-                ):
-                    self._instrumented_classes.append(class_)
-                    wrapt.wrap_function_wrapper(
-                        class_, "handle", _handle_wrapper
-                    )
-                    wrapt.wrap_function_wrapper(
-                        class_, "handle_many", _handle_many_wrapper
-                    )
-
-        wrapt.wrap_function_wrapper(
-            fastapi_events.dispatcher, "_dispatch", _dispatch_wrapper
+        # fastapi_events is only imported once instrumentation is requested
+        # to keep it out of the import time of this module.
+        from fastapi_events import dispatcher, event_store
+
+        # pylint: disable=global-statement
+        global _TRACER, _RECORD_PER_EVENT_SPANS, _TRACE_NESTED_DISPATCH
+        _TRACER = trace.get_tracer(
+            __name__, __version__, kwargs.get("tracer_provider")
         )
+        _RECORD_PER_EVENT_SPANS = kwargs.get("record_per_event_spans", False)
+        _TRACE_NESTED_DISPATCH = kwargs.get("trace_nested_dispatch", False)
+
+        # BaseInstrumentor is a singleton whose __init__ runs on every
+        # instantiation, so the state has to be reset here instead.
+        # pylint: disable=attribute-defined-outside-init
+        self._instrumented_classes = set()
+
+        for class_ in _get_handler_classes():
+            self._instrumented_classes.add(class_)
+            _patch(class_, "handle", _wrap_handle)
+            _patch(class_, "handle_many", _wrap_handle_many)
+
+        if not _is_dispatch_instrumented(dispatcher):
+            wrapper = wrapt.wrap_function_wrapper(
+                dispatcher, "_dispatch", _wrap_dispatch(event_store)
+            )
+            setattr(wrapper, _DISPATCH_INSTRUMENTED_ATTR, True)
 
     def _uninstrument(self, **kwargs):
+        from fastapi_events import dispatcher
+
+        # pylint: disable=global-statement
+        global _TRACER, _RECORD_PER_EVENT_SPANS, _TRACE_NESTED_DISPATCH
+        _TRACER = None
+        _RECORD_PER_EVENT_SPANS = False
+        _TRACE_NESTED_DISPATCH = False
+
         for class_ in self._instrumented_classes:
-            unwrap(class_, "handle")
-            unwrap(class_, "handle_many")
+            _unpatch(class_, "handle")
+            _unpatch(class_, "handle_many")
 
-        unwrap(fastapi_events.dispatcher, "dispatch")
+        unwrap(dispatcher, "_dispatch")
@@ -11,18 +11,90 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import asyncio
+import copy
+import functools
+import inspect
+import os
+import pickle
+from unittest import mock
+
+import fastapi_events.dispatcher
 from fastapi import FastAPI
 from fastapi_events.dispatcher import dispatch
+from fastapi_events.handlers.base import BaseEventHandler
 from fastapi_events.handlers.local import LocalHandler
 from fastapi_events.middleware import EventHandlerASGIMiddleware
 from starlette.testclient import TestClient
 
-from opentelemetry import trace
+from opentelemetry import context, trace
 from opentelemetry.instrumentation.fastapi_events import (
     FastAPIEventsInstrumentor,
+    _get_tracer,
+    _patch,
+    _should_trace,
+    _wrap_handle,
 )
+from opentelemetry.instrumentation.utils import _SUPPRESS_INSTRUMENTATION_KEY
+from opentelemetry.sdk.trace.sampling import ALWAYS_OFF
+from opentelemetry.semconv.trace import SpanAttributes
+from opentelemetry.test.globals_test import reset_trace_globals
 from opentelemetry.test.test_base import TestBase
-from opentelemetry.trace import SpanKind
+from opentelemetry.trace import NonRecordingSpan, SpanKind
+from opentelemetry.trace.status import StatusCode
+
+
+def async_call(coro):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+class CustomHandler(BaseEventHandler):
+    async def handle(self, event):
+        pass
+
+
+class SyncHandler(BaseEventHandler):
+    def handle(self, event):
+        return event[0]
+
+
+class FailingHandler(BaseEventHandler):
+    async def handle(self, event):
+        raise ValueError("handler failed")
+
+
+class OverridingHandler(CustomHandler):
+    async def handle(self, event):
+        await super().handle(event)
+
+    async def handle_many(self, events):
+        await super().handle_many(events)
+
+
+def passthrough(func):
+    # A decorator that is not aware of coroutine functions.
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        return func(*args, **kwargs)
+
+    return wrapper
+
+
+class DecoratedHandler(BaseEventHandler):
+    @passthrough
+    async def handle(self, event):
+        await asyncio.sleep(0)
+        with trace.get_tracer(__name__).start_as_current_span("inner"):
+            pass
+
+    @passthrough
+    async def handle_many(self, events):
+        for event in events:
+            await self.handle(event)
 
 
 class TestFastAPIEventsInstrumentor(TestBase):
@@ -32,6 +104,11 @@ class TestFastAPIEventsInstrumentor(TestBase):
         self._app = self._create_app()
         self._client = TestClient(self._app)
 
+    def tearDown(self):
+        super().tearDown()
+        with self.disable_logging():
+            FastAPIEventsInstrumentor().uninstrument()
+
     def _create_app(self):
         app = FastAPI()
         local_handler = LocalHandler()
@@ -60,20 +137,399 @@ class TestFastAPIEventsInstrumentor(TestBase):
 
         return app
 
+    def _get_handle_spans(self):
+        return [
+            span
+            for span in self.memory_exporter.get_finished_spans()
+            if span.name == "fastapi_events.handle"
+        ]
+
+    def _get_dispatched_event_names(self):
+        return sorted(
+            span.attributes[SpanAttributes.MESSAGING_DESTINATION]
+            for span in self.memory_exporter.get_finished_spans()
+            if span.name == "fastapi_events.dispatch"
+        )
+
     def test_event_handling(self):
         self._client.get("/")
 
         spans = self.memory_exporter.get_finished_spans()
-        span_names = [span._name for span in spans]
+        (handle_many_span,) = [
+            span for span in spans if span.name == "fastapi_events.handle_many"
+        ]
+        (handle_span,) = self._get_handle_spans()
 
-        self.assertIn("handling event VISITOR_SPOTTED", span_names)
-        self.assertIn("handling event VISITOR_SPOTTED_HANDLED", span_names)
-        self.assertIn("handling multiple events", span_names)
+        # VISITOR_SPOTTED is handled in the batch at the end of the request,
+        # VISITOR_SPOTTED_HANDLED is dispatched from its handler on its own.
+        self.assertEqual(
+            ["VISITOR_SPOTTED"],
+            [event.name for event in handle_many_span.events],
+        )
+        self.assertEqual(
+            "VISITOR_SPOTTED_HANDLED",
+            handle_span.attributes[SpanAttributes.MESSAGING_DESTINATION],
+        )
+        for span in (handle_many_span, handle_span):
+            self.assertEqual(span.kind, SpanKind.CONSUMER)
+            self.assertSpanHasAttributes(
+                span,
+                {
+                    SpanAttributes.MESSAGING_SYSTEM: "fastapi_events",
+                    SpanAttributes.MESSAGING_OPERATION: "process",
+                },
+            )
+
+    def test_record_per_event_spans(self):
+        FastAPIEventsInstrumentor().uninstrument()
+        FastAPIEventsInstrumentor().instrument(record_per_event_spans=True)
+
+        self._client.get("/")
+
+        spans = self.memory_exporter.get_finished_spans()
+        (handle_many_span,) = [
+            span for span in spans if span.name == "fastapi_events.handle_many"
+        ]
+        handle_spans = self._get_handle_spans()
+
+        self.assertEqual((), tuple(handle_many_span.events))
+        self.assertEqual(
+            ["VISITOR_SPOTTED", "VISITOR_SPOTTED_HANDLED"],
+            sorted(
+                span.attributes[SpanAttributes.MESSAGING_DESTINATION]
+                for span in handle_spans
+            ),
+        )
 
     def test_dispatch(self):
         self._client.get("/")
 
+        spans = self.memory_exporter.get_finished_spans()
+        dispatch_spans = [
+            span for span in spans if span.name == "fastapi_events.dispatch"
+        ]
+
+        self.assertIn(
+            "VISITOR_SPOTTED",
+            [
+                span.attributes[SpanAttributes.MESSAGING_DESTINATION]
+                for span in dispatch_spans
+            ],
+        )
+        for span in dispatch_spans:
+            self.assertEqual(span.kind, SpanKind.PRODUCER)
+            self.assertSpanHasAttributes(
+                span, {SpanAttributes.MESSAGING_SYSTEM: "fastapi_events"}
+            )
+
+    def test_no_op_tracer_provider(self):
+        FastAPIEventsInstrumentor().uninstrument()
+        FastAPIEventsInstrumentor().instrument(
+            tracer_provider=trace.NoOpTracerProvider()
+        )
+
+        self._client.get("/")
+
+        spans = self.memory_exporter.get_finished_spans()
+        span_names = [span._name for span in spans]
+
+        self.assertEqual(["handling request"], span_names)
+
+    @mock.patch.dict(os.environ, {"FASTAPI_EVENTS_DISABLE_DISPATCH": "1"})
+    def test_sampled_out_spans(self):
+        FastAPIEventsInstrumentor().uninstrument()
+        tracer_provider, memory_exporter = self.create_tracer_provider(
+            sampler=ALWAYS_OFF
+        )
+        FastAPIEventsInstrumentor().instrument(tracer_provider=tracer_provider)
+
+        with mock.patch.object(
+            NonRecordingSpan, "set_attribute"
+        ) as set_attribute:
+            fastapi_events.dispatcher._dispatch("VISITOR_SPOTTED")
+            result = SyncHandler().handle(("VISITOR_SPOTTED", None))
+            async_call(
+                CustomHandler().handle_many([("VISITOR_SPOTTED", None)])
+            )
+
+        self.assertEqual("VISITOR_SPOTTED", result)
+        set_attribute.assert_not_called()
+        self.assertEqual((), memory_exporter.get_finished_spans())
+
+    def test_proxy_tracer_without_sdk(self):
+        reset_trace_globals()
+        FastAPIEventsInstrumentor().uninstrument()
+        FastAPIEventsInstrumentor().instrument()
+
+        tracer = _get_tracer()
+        self.assertIsInstance(tracer, trace.ProxyTracer)
+        self.assertFalse(_should_trace(tracer))
+
+        result = SyncHandler().handle(("VISITOR_SPOTTED", None))
+
+        self.assertEqual("VISITOR_SPOTTED", result)
+        self.assertEqual((), self.memory_exporter.get_finished_spans())
+
+        trace.set_tracer_provider(self.tracer_provider)
+        self.assertTrue(_should_trace(tracer))
+
+    def test_uninstrument_restores_handlers(self):
+        instrumented_handle = LocalHandler.handle
+        FastAPIEventsInstrumentor().uninstrument()
+
+        self.assertIsNot(instrumented_handle, LocalHandler.handle)
+        self.assertIs(instrumented_handle.__wrapped__, LocalHandler.handle)
+        self.assertNotIn("handle_many", vars(LocalHandler))
+        self.assertIs(BaseEventHandler.handle_many, LocalHandler.handle_many)
+
+        self._client.get("/")
+
         spans = self.memory_exporter.get_finished_spans()
         span_names = [span._name for span in spans]
 
-        self.assertIn("Event VISITOR_SPOTTED dispatched", span_names)
+        self.assertNotIn("fastapi_events.handle", span_names)
+        self.assertNotIn("fastapi_events.handle_many", span_names)
+
+        FastAPIEventsInstrumentor().instrument()
+
+    def test_uninstrument_before_instrument(self):
+        instrumentor = FastAPIEventsInstrumentor()
+        instrumentor.uninstrument()
+        # pylint: disable=protected-access
+        del instrumentor._instrumented_classes
+
+        instrumentor._uninstrument()
+
+        instrumentor.instrument()
+
+    def test_custom_handler_subclass(self):
+        self.assertTrue(hasattr(CustomHandler.handle, "__wrapped__"))
+        self.assertTrue(hasattr(BaseEventHandler.handle_many, "__wrapped__"))
+        self.assertNotIn("handle_many", vars(CustomHandler))
+
+    def test_handler_subclass_calling_super(self):
+        handler = OverridingHandler()
+
+        async_call(handler.handle(("VISITOR_SPOTTED", None)))
+        async_call(handler.handle_many([("VISITOR_SPOTTED", None)]))
+
+        span_names = [
+            span.name for span in self.memory_exporter.get_finished_spans()
+        ]
+        self.assertEqual(
+            ["fastapi_events.handle", "fastapi_events.handle_many"],
+            span_names,
+        )
+
+    def test_handle_links_to_dispatch(self):
+        FastAPIEventsInstrumentor().uninstrument()
+        FastAPIEventsInstrumentor().instrument(record_per_event_spans=True)
+
+        self._client.get("/")
+
+        spans = self.memory_exporter.get_finished_spans()
+        (dispatch_span,) = [
+            span
+            for span in spans
+            if span.name == "fastapi_events.dispatch"
+            and span.attributes[SpanAttributes.MESSAGING_DESTINATION]
+            == "VISITOR_SPOTTED"
+        ]
+        (handle_many_span,) = [
+            span for span in spans if span.name == "fastapi_events.handle_many"
+        ]
+        (handle_span,) = [
+            span
+            for span in spans
+            if span.name == "fastapi_events.handle"
+            and span.attributes[SpanAttributes.MESSAGING_DESTINATION]
+            == "VISITOR_SPOTTED"
+        ]
+
+        for span in (handle_many_span, handle_span):
+            self.assertEqual(1, len(span.links))
+            self.assertEqual(dispatch_span.context, span.links[0].context)
+
+    def test_handled_events_are_untouched(self):
+        handled_events = []
+
+        class RecordingHandler(BaseEventHandler):
+            async def handle(self, event):
+                handled_events.append(event)
+
+        app = FastAPI()
+        app.add_middleware(
+            EventHandlerASGIMiddleware, handlers=[RecordingHandler()]
+        )
+
+        @app.get("/")
+        async def index():
+            dispatch("VISITOR_SPOTTED", payload={"id": 1})
+
+        FastAPIEventsInstrumentor().uninstrument()
+        FastAPIEventsInstrumentor().instrument(record_per_event_spans=True)
+        TestClient(app).get("/")
+
+        (event,) = handled_events
+        self.assertIs(tuple, type(event))
+        self.assertEqual(("VISITOR_SPOTTED", {"id": 1}), copy.copy(event))
+        self.assertEqual(("VISITOR_SPOTTED", {"id": 1}), copy.deepcopy(event))
+        self.assertEqual(
+            ("VISITOR_SPOTTED", {"id": 1}), pickle.loads(pickle.dumps(event))
+        )
+
+        spans = self.memory_exporter.get_finished_spans()
+        (dispatch_span,) = [
+            span for span in spans if span.name == "fastapi_events.dispatch"
+        ]
+        (handle_span,) = self._get_handle_spans()
+        self.assertEqual(dispatch_span.context, handle_span.links[0].context)
+
+    def test_handle_exception(self):
+        with self.assertRaises(ValueError):
+            async_call(FailingHandler().handle(("VISITOR_SPOTTED", None)))
+
+        (span,) = self.memory_exporter.get_finished_spans()
+
+        self.assertEqual("fastapi_events.handle", span.name)
+        self.assertEqual(StatusCode.ERROR, span.status.status_code)
+        self.assertEqual("ValueError: handler failed", span.status.description)
+        self.assertEqual("exception", span.events[0].name)
+
+    def test_sync_handler(self):
+        self.assertFalse(inspect.iscoroutinefunction(SyncHandler.handle))
+
+        result = SyncHandler().handle(("VISITOR_SPOTTED", None))
+
+        self.assertEqual("VISITOR_SPOTTED", result)
+        (span,) = self.memory_exporter.get_finished_spans()
+        self.assertEqual("fastapi_events.handle", span.name)
+
+    def test_non_tuple_events(self):
+        handler = CustomHandler()
+
+        async_call(handler.handle(["VISITOR_SPOTTED", None]))
+        async_call(handler.handle(object()))
+        async_call(handler.handle_many([["VISITOR_SPOTTED", None], object()]))
+
+        spans = self.memory_exporter.get_finished_spans()
+        (handle_many_span,) = [
+            span for span in spans if span.name == "fastapi_events.handle_many"
+        ]
+        handle_spans = self._get_handle_spans()
+
+        self.assertEqual(
+            ["VISITOR_SPOTTED"],
+            [event.name for event in handle_many_span.events],
+        )
+        self.assertEqual(2, len(handle_spans))
+        self.assertEqual(
+            "VISITOR_SPOTTED",
+            handle_spans[0].attributes[SpanAttributes.MESSAGING_DESTINATION],
+        )
+        self.assertNotIn(
+            SpanAttributes.MESSAGING_DESTINATION, handle_spans[1].attributes
+        )
+
+    def test_decorated_coroutine_handler(self):
+        self.assertFalse(inspect.iscoroutinefunction(DecoratedHandler.handle))
+        handler = DecoratedHandler()
+
+        for call in (
+            handler.handle(("VISITOR_SPOTTED", None)),
+            handler.handle_many([("VISITOR_SPOTTED", None)]),
+        ):
+            self.memory_exporter.clear()
+            async_call(call)
+
+            (
+                inner_span,
+                outer_span,
+            ) = self.memory_exporter.get_finished_spans()
+            self.assertEqual("inner", inner_span.name)
+            self.assertEqual(outer_span.context, inner_span.parent)
+            self.assertGreaterEqual(outer_span.end_time, inner_span.end_time)
+
+    @mock.patch.dict(os.environ, {"FASTAPI_EVENTS_DISABLE_DISPATCH": "1"})
+    def test_dispatch_positional_event_name(self):
+        fastapi_events.dispatcher._dispatch("VISITOR_SPOTTED")
+
+        (span,) = self.memory_exporter.get_finished_spans()
+        self.assertEqual("fastapi_events.dispatch", span.name)
+        self.assertEqual(
+            "VISITOR_SPOTTED",
+            span.attributes[SpanAttributes.MESSAGING_DESTINATION],
+        )
+
+    @mock.patch.dict(os.environ, {"FASTAPI_EVENTS_DISABLE_DISPATCH": "1"})
+    def test_repeated_instrumentation(self):
+        instrumentor = FastAPIEventsInstrumentor()
+        for _ in range(2):
+            instrumentor.uninstrument()
+            instrumentor.instrument()
+
+        fastapi_events.dispatcher._dispatch("VISITOR_SPOTTED")
+        self.assertEqual(1, len(self.memory_exporter.get_finished_spans()))
+
+        for _ in range(2):
+            instrumentor.uninstrument()
+
+        self.assertFalse(
+            hasattr(fastapi_events.dispatcher._dispatch, "__wrapped__")
+        )
+        self.assertFalse(hasattr(LocalHandler.handle, "__wrapped__"))
+
+        instrumentor.instrument()
+
+    def test_patch_skips_instrumented_methods(self):
+        instrumented_handle = LocalHandler.handle
+
+        _patch(LocalHandler, "handle", _wrap_handle)
+
+        self.assertIs(instrumented_handle, LocalHandler.handle)
+        self.assertIsNot(
+            instrumented_handle, LocalHandler._otel_original_handle
+        )
+
+    def test_instrument_skips_instrumented_dispatch(self):
+        instrumented_dispatch = fastapi_events.dispatcher._dispatch
+        # pylint: disable=protected-access
+        FastAPIEventsInstrumentor()._instrument()
+
+        self.assertIs(
+            instrumented_dispatch, fastapi_events.dispatcher._dispatch
+        )
+        self.assertFalse(
+            hasattr(instrumented_dispatch.__wrapped__, "__wrapped__")
+        )
+
+    def test_nested_dispatch(self):
+        self._client.get("/")
+
+        self.assertEqual(
+            ["VISITOR_SPOTTED"], self._get_dispatched_event_names()
+        )
+
+    def test_trace_nested_dispatch(self):
+        FastAPIEventsInstrumentor().uninstrument()
+        FastAPIEventsInstrumentor().instrument(trace_nested_dispatch=True)
+
+        self._client.get("/")
+
+        self.assertEqual(
+            ["VISITOR_SPOTTED", "VISITOR_SPOTTED_HANDLED"],
+            self._get_dispatched_event_names(),
+        )
+
+    @mock.patch.dict(os.environ, {"FASTAPI_EVENTS_DISABLE_DISPATCH": "1"})
+    def test_suppress_instrumentation(self):
+        token = context.attach(
+            context.set_value(_SUPPRESS_INSTRUMENTATION_KEY, True)
+        )
+        try:
+            fastapi_events.dispatcher._dispatch("VISITOR_SPOTTED")
+            async_call(CustomHandler().handle(("VISITOR_SPOTTED", None)))
+        finally:
+            context.detach(token)
+
+        self.assertEqual((), self.memory_exporter.get_finished_spans())